@@ -1,12 +1,74 @@
+"""
+Ежедневная рассылка сюр-гороскопов.
+
+    python send_daily.py                   — обойти всех пользователей (раз в день)
+    python send_daily.py --drain-retries   — отправить только подошедшие повторы
+
+Доставки, упавшие с временной ошибкой, попадают в retry_queue.json.
+Сами по себе они не повторяются: --drain-retries нужно запускать
+регулярно, например из cron каждые 5 минут:
+
+    */5 * * * * cd /path/to/bot && python send_daily.py --drain-retries
+
+Повторы живут только в пределах своего дня: вчерашние записи при
+следующем drain просто выкидываются, а не досылаются.
+"""
+
+import argparse
+import asyncio
+import fcntl
 import json
 import os
+import random
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN)
 
 USERS_FILE = "users.json"
+RETRY_FILE = "retry_queue.json"
+LOCK_FILE = "send_daily.lock"
+
+# Параметры повторных попыток: экспоненциальная задержка с джиттером.
+# Задержки ~1, 2, 4, 8, 16, 32 мин, дальше упираются в потолок 1 ч;
+# всего RETRY_MAX_ATTEMPTS попыток — это примерно 3–6 часов, т.е. в
+# пределах одного дня рассылки.
+RETRY_BASE_DELAY = 60          # секунд до первой повторной попытки
+RETRY_MAX_DELAY = 60 * 60      # потолок задержки
+RETRY_MAX_ATTEMPTS = 12        # после этого запись помечается как dead
+
+# Сколько раз подряд ждать flood control для одного пользователя,
+# прежде чем отложить его в очередь
+FLOOD_WAIT_ATTEMPTS = 3
+
+# Как часто (в пользователях) сбрасывать очередь и отметки на диск,
+# чтобы падение посреди рассылки не теряло уже сделанное
+FLUSH_EVERY = 50
+
+# Сколько раз перечитывать users.json, если bot.py как раз его пишет
+USERS_RELOAD_ATTEMPTS = 3
+
+# Временные ошибки, которые имеет смысл повторить
+TRANSIENT_ERRORS = (
+    TelegramNetworkError,
+    TelegramServerError,
+    asyncio.TimeoutError,
+)
+
+def write_json_atomic(path, data):
+    """Пишем во временный файл и подменяем, чтобы не оставить битый JSON."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
 
 def load_users():
     if not os.path.exists(USERS_FILE):
@@ -14,46 +76,239 @@ def load_users():
     with open(USERS_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def save_users(data):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def reload_users(fallback):
+    """
+    bot.py пишет users.json не атомарно, поэтому чтение может попасть на
+    недописанный файл. Пробуем несколько раз, а если не вышло — берём
+    снимок, прочитанный при старте.
+    """
+    for attempt in range(USERS_RELOAD_ATTEMPTS):
+        try:
+            return load_users()
+        except Exception as e:
+            error = e
+            time.sleep(0.5 * (attempt + 1))
+
+    print(f"Не удалось перечитать {USERS_FILE}, пишем по снимку со старта: {error}")
+    return fallback
+
+def save_sent(sent, fallback):
+    """
+    Перечитывает users.json и проставляет last_sent_date только тем, кому
+    мы действительно отправили, — чтобы не затереть то, что за это время
+    записал bot.py (смена знака/стиля, /today). Дата никогда не откатывается
+    назад.
+    """
+    if not sent:
+        return
+
+    users = reload_users(fallback)
+    for uid, day in sent.items():
+        data = users.get(uid)
+        if data is not None and (data.get("last_sent_date") or "") < day:
+            data["last_sent_date"] = day
+
+    write_json_atomic(USERS_FILE, users)
+    sent.clear()
+
+def load_retries():
+    if not os.path.exists(RETRY_FILE):
+        return {}
+    try:
+        with open(RETRY_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Очередь повторов {RETRY_FILE} повреждена, начинаем с пустой: {e}")
+        return {}
+
+def save_retries(data):
+    write_json_atomic(RETRY_FILE, data)
+
+def flush(retries, sent, users):
+    """Сначала очередь — её потеря дороже, чем повторная отметка."""
+    save_retries(retries)
+    save_sent(sent, users)
+
+@contextmanager
+def send_lock(blocking=True):
+    """
+    Не даём обычной рассылке и drain работать одновременно.
+    Отдаёт False, если blocking=False и замок уже кем-то взят.
+    """
+    with open(LOCK_FILE, "w") as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def backoff_delay(attempts, error=None):
+    """
+    Задержка перед следующей попыткой: BASE * 2^(attempts-1), не больше
+    MAX, из которой случайна вторая половина (equal jitter), чтобы
+    повторы после общего сбоя не били в Telegram одновременно.
+    Если Telegram сам попросил подождать (RetryAfter) — ждём не меньше.
+    """
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if isinstance(error, TelegramRetryAfter):
+        delay = max(delay, error.retry_after)
+    return delay
+
+def schedule_retry(retries, uid, day, error):
+    """Кладёт (или обновляет) неудавшуюся доставку в очередь повторов."""
+    item = retries.get(uid)
+    if item is None or item.get("date") != day:
+        item = {"date": day, "attempts": 0}
+
+    item["attempts"] += 1
+    item["last_error"] = str(error)
+    retries[uid] = item
+
+    if item["attempts"] >= RETRY_MAX_ATTEMPTS:
+        # Оставляем запись в очереди, чтобы было видно, кому не дошло;
+        # drain её больше не трогает и выкинет на следующий день
+        if not item.get("dead"):
+            print(f"Сдаёмся на {uid} после {item['attempts']} попыток: {error}")
+        item["dead"] = True
+        return
+
+    item["next_try"] = time.time() + backoff_delay(item["attempts"], error)
 
 with open("horoscopes.json", "r", encoding="utf-8") as f:
     HOROS = json.load(f)
 
 today = datetime.now().date().isoformat()
-users = load_users()
 
-async def main():
-    for uid, data in users.items():
-        zodiac = data.get("zodiac")
-        style = data.get("style", "classic")
+async def send_horoscope(uid, data, day):
+    """
+    Отправляет пользователю гороскоп на day.
+    Возвращает False, если отправлять нечего (уже получил или нет текста).
+    """
+    zodiac = data.get("zodiac")
+    style = data.get("style", "classic")
+
+    # НЕ слать, если пользователь уже получил гороскоп за этот день или позже
+    if (data.get("last_sent_date") or "") >= day:
+        return False
+
+    # Проверяем наличие гороскопа
+    if day not in HOROS:
+        return False
+    if zodiac not in HOROS[day]:
+        return False
 
-        # НЕ слать, если пользователь уже получил сегодня
-        if data.get("last_sent_date") == today:
-            continue
+    horoscope_text = HOROS[day][zodiac][style]
 
-        # Проверяем наличие гороскопа
-        if today not in HOROS:
-            continue
-        if zodiac not in HOROS[today]:
-            continue
+    await bot.send_message(
+        int(uid),
+        f"🔮 Твой новый сюр-гороскоп готов!\n\n{horoscope_text}"
+    )
+    return True
 
-        horoscope_text = HOROS[today][zodiac][style]
+async def deliver(uid, data, day, retries, sent):
+    error = None
 
+    for _ in range(FLOOD_WAIT_ATTEMPTS):
         try:
-            await bot.send_message(
-                int(uid),
-                f"🔮 Твой новый сюр-гороскоп готов!\n\n{horoscope_text}"
-            )
-            # записываем, что он получил гороскоп
-            data["last_sent_date"] = today
+            if await send_horoscope(uid, data, day):
+                # записываем, что он получил гороскоп
+                sent[uid] = day
+            retries.pop(uid, None)
+            return
+
+        except TelegramRetryAfter as e:
+            # Flood control: стоим на месте, а не долбим остальных пользователей
+            print(f"Flood control на {uid}, ждём {e.retry_after} с")
+            error = e
+            await asyncio.sleep(e.retry_after)
+
+        except TRANSIENT_ERRORS as e:
+            print(f"Не удалось отправить {uid}, повторим позже: {e}")
+            schedule_retry(retries, uid, day, e)
+            return
 
         except Exception as e:
+            # Постоянная ошибка (бот заблокирован, чат не найден) — не повторяем
             print(f"Не удалось отправить {uid}: {e}")
+            retries.pop(uid, None)
+            return
 
-    save_users(users)
+    print(f"Не удалось отправить {uid} из-за flood control, повторим позже")
+    schedule_retry(retries, uid, day, error)
+
+async def main():
+    with send_lock():
+        users = load_users()
+        retries = load_retries()
+        sent = {}
+
+        try:
+            for i, (uid, data) in enumerate(users.items(), start=1):
+                await deliver(uid, data, today, retries, sent)
+                if i % FLUSH_EVERY == 0:
+                    flush(retries, sent, users)
+        finally:
+            flush(retries, sent, users)
+
+    pending = sum(1 for item in retries.values() if not item.get("dead"))
+    if pending:
+        print(
+            f"В очереди повторов {pending} доставок. Они уйдут только при "
+            f"запуске `python send_daily.py --drain-retries` (например, из cron)."
+        )
+
+async def drain_retries():
+    """Обрабатывает только те повторы из очереди, чьё время уже подошло."""
+    with send_lock(blocking=False) as locked:
+        if not locked:
+            print("Рассылка или другой drain уже идёт, пропускаем этот запуск.")
+            return
+
+        users = load_users()
+        retries = load_retries()
+        sent = {}
+        now = time.time()
+
+        # Вчерашние повторы не досылаем: это был бы уже старый гороскоп
+        for uid in [uid for uid, item in retries.items() if item.get("date") != today]:
+            retries.pop(uid)
+
+        due = [
+            uid for uid, item in retries.items()
+            if not item.get("dead") and item.get("next_try", 0) <= now
+        ]
+
+        try:
+            for i, uid in enumerate(due, start=1):
+                data = users.get(uid)
+                if data is None:
+                    retries.pop(uid, None)
+                    continue
+                await deliver(uid, data, today, retries, sent)
+                if i % FLUSH_EVERY == 0:
+                    flush(retries, sent, users)
+        finally:
+            flush(retries, sent, users)
+
+    dead = sum(1 for item in retries.values() if item.get("dead"))
+    print(
+        f"Обработано повторов: {len(due)}, ждут повтора: {len(retries) - dead}, "
+        f"отброшено (dead): {dead}"
+    )
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Ежедневная рассылка гороскопов")
+    parser.add_argument(
+        "--drain-retries",
+        action="store_true",
+        help="обработать только подошедшие повторы из очереди, без обхода всех пользователей",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(drain_retries() if args.drain_retries else main())